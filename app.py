@@ -12,7 +12,6 @@ import pandas as pd
 from pathlib import Path
 from decimal import Decimal
 from lxml import etree
-import collections
 from datetime import datetime
 import base64
 import io
@@ -72,6 +71,9 @@ st.markdown("""
 NS_2007 = {"ns": "http://ns.hr-xml.org/2007-04-15", "oa": "http://www.openapplications.org/oagis"}
 NS_2004 = {"ns": "http://ns.hr-xml.org/2004-08-02", "oa": "http://www.openapplications.org/oagis"}
 
+# Parser XML partagé pour les factures (encodage lu par libxml2 dans le BOM / prologue)
+_INVOICE_PARSER = etree.XMLParser(remove_blank_text=True, ns_clean=True)
+
 # Configuration des rubriques par défaut
 DEFAULT_RUBRICS = {
     "100010": ("Base Contrat", 23.70, "BL"),
@@ -83,15 +85,60 @@ DEFAULT_RUBRICS = {
     "400200": ("Prime de 13 ème Mois", 0.00, "BL"),
 }
 
+# Devise des montants facturés
+CURRENCY = "EUR"
+
+# Tags OAGIS en notation Clark (namespace identique en 2004 et 2007)
+OA_LINE_TAG = "{%s}Line" % NS_2007["oa"]
+OA_DESCRIPTION_TAG = "{%s}Description" % NS_2007["oa"]
+OA_LINENUMBER_TAG = "{%s}LineNumber" % NS_2007["oa"]
+OA_ITEMQUANTITY_TAG = "{%s}ItemQuantity" % NS_2007["oa"]
+OA_CHARGES_TAG = "{%s}Charges" % NS_2007["oa"]
+OA_CHARGE_TAG = "{%s}Charge" % NS_2007["oa"]
+OA_TOTAL_TAG = "{%s}Total" % NS_2007["oa"]
+OA_CHARGE_TOTAL_PATH = "%s/%s" % (OA_CHARGE_TAG, OA_TOTAL_TAG)
+OA_REASONCODE_TAG = "{%s}ReasonCode" % NS_2007["oa"]
+OA_PRICE_TAG = "{%s}Price" % NS_2007["oa"]
+OA_AMOUNT_TAG = "{%s}Amount" % NS_2007["oa"]
+OA_FUNCTIONALAMOUNT_TAG = "{%s}FunctionalAmount" % NS_2007["oa"]
+OA_PERQUANTITY_TAG = "{%s}PerQuantity" % NS_2007["oa"]
+OA_HEADER_TAG = "{%s}Header" % NS_2007["oa"]
+OA_USERAREA_TAG = "{%s}UserArea" % NS_2007["oa"]
+OA_TOTALCHARGES_TAG = "{%s}TotalCharges" % NS_2007["oa"]
+OA_TOTALTAX_TAG = "{%s}TotalTax" % NS_2007["oa"]
+OA_TOTALAMOUNT_TAG = "{%s}TotalAmount" % NS_2007["oa"]
+
+# Tags TimeCard suivis lors du parsing incrémental du RAV
+TIMECARD_TAGS = ["{%s}TimeCard" % NS_2007["ns"], "{%s}TimeCard" % NS_2004["ns"]]
+
+# Tags HR-XML du RAV en notation Clark (une table par namespace)
+RAV_TAG_NAMES = [
+    "TimeCardId", "IdValue", "Id", "ReportedTime", "PeriodStartDate", "PeriodEndDate",
+    "TimeInterval", "RateOrAmount", "PayTypeCode", "Duration",
+]
+
+RAV_TAGS = {
+    uri: {name: "{%s}%s" % (uri, name) for name in RAV_TAG_NAMES}
+    for uri in (NS_2007["ns"], NS_2004["ns"])
+}
+
 # ═══════════════════════════════════════════════════════════════════════════
 # FONCTIONS UTILITAIRES
 # ═══════════════════════════════════════════════════════════════════════════
 
-@st.cache_data
+def decimal_rubrics(rubrics: Dict[str, Tuple]) -> Dict[str, Tuple[str, Decimal, str]]:
+    """Convertit les taux des rubriques en Decimal"""
+    return {code: (libelle, Decimal(str(taux)), type_ligne) for code, (libelle, taux, type_ligne) in rubrics.items()}
+
+@st.cache_resource
+def get_default_rubrics() -> Dict[str, Tuple[str, Decimal, str]]:
+    """Table des rubriques par défaut, partagée entre les sessions (ne pas modifier)"""
+    return decimal_rubrics(DEFAULT_RUBRICS)
+
 def load_rubrics():
     """Charge les rubriques depuis la session ou les valeurs par défaut"""
     if 'rubrics' not in st.session_state:
-        st.session_state.rubrics = DEFAULT_RUBRICS.copy()
+        st.session_state.rubrics = dict(get_default_rubrics())
     return st.session_state.rubrics
 
 def detect_namespace(tree):
@@ -110,6 +157,55 @@ def detect_namespace(tree):
         else:
             return NS_2004
 
+def format_decimal(value: Decimal) -> str:
+    """Formate un Decimal en notation française (virgule décimale)"""
+    return format(value, 'f').replace('.', ',', 1)
+
+def build_preview(content: bytes, encoding: str, max_lines: int = 50) -> str:
+    """Décode uniquement les premières lignes du XML généré pour l'aperçu"""
+    end = -1
+    for _ in range(max_lines):
+        end = content.find(b'\n', end + 1)
+        if end == -1:
+            return content.decode(encoding)
+    return content[:end].decode(encoding) + "\n... (fichier tronqué pour l'affichage)"
+
+def find_child_path(elem: etree._Element, *tags: str) -> Optional[etree._Element]:
+    """Descend d'enfant direct en enfant direct selon les tags (notation Clark)"""
+    for tag in tags:
+        elem = elem.find(tag)
+        if elem is None:
+            return None
+    return elem
+
+def find_invoice(tree: etree._Element, ns: Dict[str, str]) -> Optional[etree._Element]:
+    """Trouve le premier élément Invoice (avec ou sans namespace)"""
+    invoice = next(tree.iterdescendants("{%s}Invoice" % ns["ns"]), None)
+    if invoice is None:
+        invoice = next(tree.iterdescendants("Invoice"), None)
+    return invoice
+
+def find_main_line(invoice: etree._Element) -> Optional[etree._Element]:
+    """Trouve la ligne principale de facturation (LineNumber = 1)"""
+    for line in invoice.iterdescendants(OA_LINE_TAG):
+        line_num = line.find(OA_LINENUMBER_TAG)
+        if line_num is not None and line_num.text == "1":
+            return line
+    return None
+
+def get_staffing_info(header: etree._Element, staffing_info_tag: str) -> etree._Element:
+    """Retourne Header/UserArea/StaffingInvoiceInfo (enfants directs), en les créant si besoin"""
+    user_area = header.find(OA_USERAREA_TAG)
+    if user_area is None:
+        user_area = etree.SubElement(header, OA_USERAREA_TAG)
+    
+    staffing_info = user_area.find(staffing_info_tag)
+    if staffing_info is None:
+        staffing_info = user_area.find("StaffingInvoiceInfo")
+    if staffing_info is None:
+        staffing_info = etree.SubElement(user_area, staffing_info_tag)
+    return staffing_info
+
 def validate_file_size(content: bytes, filename: str, max_size_mb: int = 20) -> Tuple[bool, str]:
     """Valide que le fichier ne dépasse pas la limite Pixid"""
     size_bytes = len(content)
@@ -120,28 +216,42 @@ def validate_file_size(content: bytes, filename: str, max_size_mb: int = 20) ->
     
     return True, f"Taille: {size_mb:.2f} Mo"
 
-def read_rav_content(rav_content: str) -> Tuple[Dict[str, Decimal], str, str, str, List[Dict]]:
-    """Parse le contenu XML du RAV et extrait les informations"""
-    parser = etree.XMLParser(remove_blank_text=True, ns_clean=True, recover=True)
-    tree = etree.fromstring(rav_content.encode('utf-8'), parser)
+def read_rav_content(rav_content: bytes) -> Tuple[Dict[str, Decimal], str, str, str, List[Dict], Optional[Dict[str, str]]]:
+    """Parse le contenu XML du RAV et extrait les informations (ainsi que le namespace détecté)"""
+    events = etree.iterparse(
+        io.BytesIO(rav_content),
+        events=('end',),
+        tag=TIMECARD_TAGS,
+        remove_blank_text=True,
+        recover=True
+    )
     
-    ns = detect_namespace(etree.ElementTree(tree))
+    ns = None
+    tags = None
     
-    qty_dict = collections.defaultdict(Decimal)
+    # Durées cumulées en centièmes d'heure (entiers, conversion en Decimal à la fin)
+    qty_centimes = {}
     all_periods = []
     timecard_id = ""
     details = []
     
-    # Chercher les TimeCard
-    for timecard in tree.xpath(".//ns:TimeCard", namespaces=ns):
+    # Parcourir les TimeCard au fil du parsing
+    for _, timecard in events:
+        # Le namespace est déduit du premier TimeCard rencontré
+        if ns is None:
+            ns = NS_2007 if timecard.tag == TIMECARD_TAGS[0] else NS_2004
+            tags = RAV_TAGS[ns["ns"]]
+        
         # Récupérer l'ID
         tc_id = None
-        tc_id_elem = timecard.find(".//ns:TimeCardId/ns:IdValue", namespaces=ns)
-        if tc_id_elem is not None:
-            tc_id = tc_id_elem.text
+        for tc_id_parent in timecard.iterdescendants(tags["TimeCardId"]):
+            tc_id_elem = tc_id_parent.find(tags["IdValue"])
+            if tc_id_elem is not None:
+                tc_id = tc_id_elem.text
+                break
         
         if not tc_id:
-            tc_id_elem = timecard.find("ns:Id/ns:IdValue", namespaces=ns)
+            tc_id_elem = find_child_path(timecard, tags["Id"], tags["IdValue"])
             if tc_id_elem is not None:
                 tc_id = tc_id_elem.text
         
@@ -149,49 +259,56 @@ def read_rav_content(rav_content: str) -> Tuple[Dict[str, Decimal], str, str, st
             timecard_id = tc_id
         
         # Récupérer les périodes
-        reported_time = timecard.find(".//ns:ReportedTime", namespaces=ns)
+        reported_time = next(timecard.iterdescendants(tags["ReportedTime"]), None)
         if reported_time is not None:
-            period_start = reported_time.findtext("ns:PeriodStartDate", namespaces=ns)
-            period_end = reported_time.findtext("ns:PeriodEndDate", namespaces=ns)
+            period_start = reported_time.findtext(tags["PeriodStartDate"])
+            period_end = reported_time.findtext(tags["PeriodEndDate"])
             if period_start and period_end:
                 all_periods.append((period_start, period_end))
         
         if not all_periods:
-            period_start = timecard.findtext("ns:PeriodStartDate", namespaces=ns)
-            period_end = timecard.findtext("ns:PeriodEndDate", namespaces=ns)
+            period_start = timecard.findtext(tags["PeriodStartDate"])
+            period_end = timecard.findtext(tags["PeriodEndDate"])
             if period_start and period_end:
                 all_periods.append((period_start, period_end))
         
         # Récupérer les TimeInterval
-        for time_interval in timecard.xpath(".//ns:TimeInterval", namespaces=ns):
+        for time_interval in timecard.iterdescendants(tags["TimeInterval"]):
             code = None
             
-            code_elem = time_interval.find("ns:Id/ns:IdValue", namespaces=ns)
+            code_elem = find_child_path(time_interval, tags["Id"], tags["IdValue"])
             if code_elem is not None:
                 code = code_elem.text
             
             if not code:
-                code_elem = time_interval.find("ns:RateOrAmount/ns:Id/ns:IdValue", namespaces=ns)
+                code_elem = find_child_path(time_interval, tags["RateOrAmount"], tags["Id"], tags["IdValue"])
                 if code_elem is not None:
                     code = code_elem.text
             
             if not code:
-                code_elem = time_interval.find("ns:PayTypeCode", namespaces=ns)
+                code_elem = time_interval.find(tags["PayTypeCode"])
                 if code_elem is not None:
                     code = code_elem.text
             
-            duration_str = time_interval.findtext("ns:Duration", default="0", namespaces=ns)
+            duration_str = time_interval.findtext(tags["Duration"], default="0")
             
             if code and duration_str and duration_str != "0":
-                duration_centimes = Decimal(duration_str.replace(",", "."))
-                heures = duration_centimes / Decimal("100")
-                qty_dict[code] += heures
+                try:
+                    duration_centimes = int(duration_str)
+                except ValueError:
+                    duration_centimes = Decimal(duration_str.replace(",", "."))
+                qty_centimes[code] = qty_centimes.get(code, 0) + duration_centimes
                 
                 details.append({
                     'code': code,
-                    'heures': float(heures),
+                    'heures': float(duration_centimes / 100),
                     'timecard_id': tc_id
                 })
+        
+        # Libérer la mémoire des TimeCard déjà traités
+        timecard.clear()
+        while timecard.getprevious() is not None:
+            del timecard.getparent()[0]
     
     if all_periods:
         period_start = min(period[0] for period in all_periods)
@@ -200,46 +317,45 @@ def read_rav_content(rav_content: str) -> Tuple[Dict[str, Decimal], str, str, st
         period_start = ""
         period_end = ""
     
-    return dict(qty_dict), period_start, period_end, timecard_id, details
+    qty_dict = {code: Decimal(centimes) / 100 for code, centimes in qty_centimes.items()}
+    
+    return qty_dict, period_start, period_end, timecard_id, details, ns
 
-def update_invoice(invoice_content: str, rav_data: Dict) -> str:
-    """Met à jour la facture avec les données du RAV"""
+def document_encoding(tree: etree._Element) -> str:
+    """Encodage déclaré du document, lu par le parser (UTF-8 par défaut, comme en XML)"""
+    return tree.getroottree().docinfo.encoding or 'UTF-8'
+
+def parse_invoice(invoice_content: bytes) -> Tuple[etree._Element, Dict[str, str]]:
+    """Parse la facture (octets bruts) et détecte son namespace"""
+    tree = etree.fromstring(invoice_content, _INVOICE_PARSER)
+    
+    ns = detect_namespace(etree.ElementTree(tree))
+    return tree, ns
+
+def update_invoice(tree: etree._Element, ns: Dict[str, str], rav_data: Dict,
+                   rubrics: Dict[str, Tuple[str, Decimal, str]], encoding: str) -> bytes:
+    """Met à jour la facture (déjà parsée) avec les données du RAV"""
     qty_dict = rav_data['quantities']
     period_start = rav_data['period_start']
     period_end = rav_data['period_end']
     timecard_id = rav_data['timecard_id']
-    rubrics = load_rubrics()
-    
-    # Parser la facture
-    parser = etree.XMLParser(remove_blank_text=True, encoding='ISO-8859-1')
-    try:
-        tree = etree.fromstring(invoice_content.encode('ISO-8859-1'), parser)
-    except:
-        parser = etree.XMLParser(remove_blank_text=True, encoding='UTF-8')
-        tree = etree.fromstring(invoice_content.encode('UTF-8'), parser)
     
-    ns = detect_namespace(etree.ElementTree(tree))
+    staffing_info_tag = "{%s}StaffingInvoiceInfo" % ns["ns"]
+    timecard_id_tag = "{%s}TimeCardId" % ns["ns"]
+    id_value_tag = "{%s}IdValue" % ns["ns"]
+    supplier_org_unit_tag = "{%s}StaffingSupplierOrgUnitId" % ns["ns"]
+    reported_time_tag = "{%s}ReportedTime" % ns["ns"]
+    ref_info_tag = "{%s}ReferenceInformation" % ns["ns"]
     
     # Trouver l'Invoice
-    invoice = tree.find(".//ns:Invoice", namespaces=ns)
-    if invoice is None:
-        invoice = tree.find(".//Invoice")
-    
+    invoice = find_invoice(tree, ns)
     if invoice is None:
         raise ValueError("Structure Invoice non trouvée")
     
     # 1. Mise à jour des périodes
-    header = invoice.find(".//{%s}Header" % ns["oa"])
+    header = invoice.find(OA_HEADER_TAG)
     if header is not None:
-        user_area = header.find("{%s}UserArea" % ns["oa"])
-        if user_area is None:
-            user_area = etree.SubElement(header, "{%s}UserArea" % ns["oa"])
-        
-        staffing_info = user_area.find("ns:StaffingInvoiceInfo", namespaces=ns)
-        if staffing_info is None:
-            staffing_info = user_area.find("StaffingInvoiceInfo")
-        if staffing_info is None:
-            staffing_info = etree.SubElement(user_area, "{%s}StaffingInvoiceInfo" % ns["ns"])
+        staffing_info = get_staffing_info(header, staffing_info_tag)
         
         # Mettre à jour les DataInformation
         period_start_exists = False
@@ -265,21 +381,27 @@ def update_invoice(invoice_content: str, rav_data: Dict) -> str:
             data_info.set("value", period_end)
     
     # 2. Mise à jour du TimeCardId
-    ref_info = invoice.find(".//ns:ReportedTime/ns:ReferenceInformation", namespaces=ns)
+    ref_info = None
+    for reported_time in invoice.iterdescendants(reported_time_tag):
+        ref_info = reported_time.find(ref_info_tag)
+        if ref_info is not None:
+            break
     if ref_info is None:
-        ref_info = invoice.find(".//ns:ReferenceInformation", namespaces=ns)
+        ref_info = next(invoice.iterdescendants(ref_info_tag), None)
     
     if ref_info is not None and timecard_id:
-        timecard_elem = ref_info.find("ns:TimeCardId", namespaces=ns)
+        timecard_elem = ref_info.find(timecard_id_tag)
         if timecard_elem is None:
+            # Insérer après le dernier StaffingSupplierOrgUnitId
             insert_position = None
-            for i, elem in enumerate(ref_info):
-                if elem.tag.endswith("StaffingSupplierOrgUnitId"):
+            for i in range(len(ref_info) - 1, -1, -1):
+                if ref_info[i].tag == supplier_org_unit_tag:
                     insert_position = i + 1
+                    break
             
-            timecard_elem = etree.Element("{%s}TimeCardId" % ns["ns"])
+            timecard_elem = etree.Element(timecard_id_tag)
             timecard_elem.set("idOwner", "EXT0")
-            id_value = etree.SubElement(timecard_elem, "{%s}IdValue" % ns["ns"])
+            id_value = etree.SubElement(timecard_elem, id_value_tag)
             id_value.text = timecard_id
             
             if insert_position is not None:
@@ -288,28 +410,55 @@ def update_invoice(invoice_content: str, rav_data: Dict) -> str:
                 ref_info.append(timecard_elem)
     
     # 3. Mise à jour des lignes de facturation
-    main_line = invoice.find(".//{%s}Line[{%s}LineNumber='1']" % (ns["oa"], ns["oa"]))
+    main_line = find_main_line(invoice)
     
     if main_line is not None:
         # Mettre à jour la description
-        desc_elems = main_line.findall("{%s}Description" % ns["oa"])
+        desc_elems = main_line.findall(OA_DESCRIPTION_TAG)
         for desc in desc_elems:
             if desc.text and "Prestations du" in desc.text and period_start and period_end:
                 desc.text = f"Prestations du {period_start} au {period_end}"
         
-        # Gérer les sous-lignes
+        # Gérer les sous-lignes (un seul parcours des enfants par sous-ligne)
         existing_lines = {}
         existing_line_numbers = []
         
-        for subline in main_line.findall("{%s}Line" % ns["oa"]):
-            desc_elem = subline.find("{%s}Description" % ns["oa"])
-            line_num_elem = subline.find("{%s}LineNumber" % ns["oa"])
+        for subline in main_line.findall(OA_LINE_TAG):
+            desc_elem = None
+            line_num_elem = None
+            qty_elem = None
+            charges_elem = None
+            
+            for child in subline:
+                tag = child.tag
+                if tag == OA_DESCRIPTION_TAG:
+                    if desc_elem is None:
+                        desc_elem = child
+                elif tag == OA_LINENUMBER_TAG:
+                    if line_num_elem is None:
+                        line_num_elem = child
+                elif tag == OA_ITEMQUANTITY_TAG:
+                    if qty_elem is None:
+                        qty_elem = child
+                elif tag == OA_CHARGES_TAG:
+                    if charges_elem is None:
+                        charges_elem = child
             
             if line_num_elem is not None:
                 existing_line_numbers.append(line_num_elem.text)
             
             if desc_elem is not None and desc_elem.text:
-                existing_lines[desc_elem.text] = subline
+                qty = Decimal("0")
+                if qty_elem is not None and qty_elem.text:
+                    qty = Decimal(qty_elem.text.replace(",", "."))
+                
+                montant = Decimal("0")
+                if charges_elem is not None:
+                    charge_elem = charges_elem.find(OA_CHARGE_TOTAL_PATH)
+                    if charge_elem is not None and charge_elem.text:
+                        montant = Decimal(charge_elem.text.replace(",", "."))
+                
+                existing_lines[desc_elem.text] = (qty, montant)
         
         # Déterminer le prochain numéro
         if existing_line_numbers:
@@ -332,28 +481,21 @@ def update_invoice(invoice_content: str, rav_data: Dict) -> str:
         total_montant_ht = Decimal("0.00")
         
         # Calculer les totaux existants
-        for subline in existing_lines.values():
-            qty_elem = subline.find("{%s}ItemQuantity" % ns["oa"])
-            charge_elem = subline.find(".//{%s}Total" % ns["oa"])
-            
-            if qty_elem is not None and qty_elem.text:
-                qty = Decimal(qty_elem.text.replace(",", "."))
-                total_heures += qty
-            
-            if charge_elem is not None and charge_elem.text:
-                montant = Decimal(charge_elem.text.replace(",", "."))
-                total_montant_ht += montant
+        for qty, montant in existing_lines.values():
+            total_heures += qty
+            total_montant_ht += montant
         
         # Ajouter/mettre à jour les nouvelles rubriques
+        rubrics_get = rubrics.get
         for code, heures in sorted(qty_dict.items()):
             if not code or heures == 0:
                 continue
             
             heures = heures.quantize(Decimal("0.00"))
             
-            if code in rubrics:
-                libelle, taux, type_ligne = rubrics[code]
-                taux = Decimal(str(taux))
+            rubric = rubrics_get(code)
+            if rubric is not None:
+                libelle, taux, type_ligne = rubric
             else:
                 libelle = f"Rubrique {code}"
                 taux = Decimal("0.00")
@@ -363,83 +505,82 @@ def update_invoice(invoice_content: str, rav_data: Dict) -> str:
             
             if libelle not in existing_lines:
                 # Créer une nouvelle ligne
-                new_line = etree.SubElement(main_line, "{%s}Line" % ns["oa"])
+                new_line = etree.SubElement(main_line, OA_LINE_TAG)
                 
-                line_num = etree.SubElement(new_line, "{%s}LineNumber" % ns["oa"])
+                line_num = etree.SubElement(new_line, OA_LINENUMBER_TAG)
                 line_num.text = f"1.{next_line_number}"
                 next_line_number += 1
                 
-                desc = etree.SubElement(new_line, "{%s}Description" % ns["oa"])
+                desc = etree.SubElement(new_line, OA_DESCRIPTION_TAG)
                 desc.text = libelle
                 
-                reason = etree.SubElement(new_line, "{%s}ReasonCode" % ns["oa"])
+                reason = etree.SubElement(new_line, OA_REASONCODE_TAG)
                 reason.text = type_ligne
                 
-                charges = etree.SubElement(new_line, "{%s}Charges" % ns["oa"])
-                charge = etree.SubElement(charges, "{%s}Charge" % ns["oa"])
-                total = etree.SubElement(charge, "{%s}Total" % ns["oa"])
-                total.set("currency", "EUR")
-                total.text = str(montant).replace(".", ",")
+                charges = etree.SubElement(new_line, OA_CHARGES_TAG)
+                charge = etree.SubElement(charges, OA_CHARGE_TAG)
+                total = etree.SubElement(charge, OA_TOTAL_TAG)
+                total.set("currency", CURRENCY)
+                total.text = format_decimal(montant)
                 
                 if taux > 0:
-                    price = etree.SubElement(new_line, "{%s}Price" % ns["oa"])
-                    amount = etree.SubElement(price, "{%s}Amount" % ns["oa"])
-                    amount.set("currency", "EUR")
-                    amount.text = str(taux).replace(".", ",")
+                    price = etree.SubElement(new_line, OA_PRICE_TAG)
+                    amount = etree.SubElement(price, OA_AMOUNT_TAG)
+                    amount.set("currency", CURRENCY)
+                    amount.text = format_decimal(taux)
                     
-                    func_amount = etree.SubElement(price, "{%s}FunctionalAmount" % ns["oa"])
-                    func_amount.set("currency", "EUR")
+                    func_amount = etree.SubElement(price, OA_FUNCTIONALAMOUNT_TAG)
+                    func_amount.set("currency", CURRENCY)
                     func_amount.text = "12.46000"
                     
-                    per_qty = etree.SubElement(price, "{%s}PerQuantity" % ns["oa"])
+                    per_qty = etree.SubElement(price, OA_PERQUANTITY_TAG)
                     per_qty.set("uom", "percent")
                     per_qty.text = "1.90"
                 
-                item_qty = etree.SubElement(new_line, "{%s}ItemQuantity" % ns["oa"])
+                item_qty = etree.SubElement(new_line, OA_ITEMQUANTITY_TAG)
                 item_qty.set("uom", "hur" if "Heure" in libelle else "pce")
-                item_qty.text = str(heures).replace(".", ",")
+                item_qty.text = format_decimal(heures)
                 
                 total_heures += heures
                 total_montant_ht += montant
         
         # Mettre à jour les totaux
-        main_charges = main_line.find(".//{%s}Total" % ns["oa"])
+        main_charges = find_child_path(main_line, OA_CHARGES_TAG, OA_CHARGE_TAG, OA_TOTAL_TAG)
         if main_charges is not None:
-            main_charges.text = str(total_montant_ht).replace(".", ",")
+            main_charges.text = format_decimal(total_montant_ht)
         
-        main_qty = main_line.find("{%s}ItemQuantity" % ns["oa"])
+        main_qty = main_line.find(OA_ITEMQUANTITY_TAG)
         if main_qty is not None:
-            main_qty.text = str(total_heures).replace(".", ",")
+            main_qty.text = format_decimal(total_heures)
         
         # Totaux dans le Header
         if header is not None:
-            total_charges = header.find("{%s}TotalCharges" % ns["oa"])
+            total_charges = header.find(OA_TOTALCHARGES_TAG)
             if total_charges is not None:
-                total_charges.text = str(total_montant_ht).replace(".", ",")
+                total_charges.text = format_decimal(total_montant_ht)
             
-            total_tax = header.find("{%s}TotalTax" % ns["oa"])
+            total_tax = header.find(OA_TOTALTAX_TAG)
             if total_tax is not None:
                 tva = (total_montant_ht * Decimal("0.20")).quantize(Decimal("0.01"))
-                total_tax.text = str(tva).replace(".", ",")
+                total_tax.text = format_decimal(tva)
             
-            total_amount = header.find("{%s}TotalAmount" % ns["oa"])
+            total_amount = header.find(OA_TOTALAMOUNT_TAG)
             if total_amount is not None:
                 ttc = total_montant_ht + (total_montant_ht * Decimal("0.20"))
                 ttc = ttc.quantize(Decimal("0.01"))
-                total_amount.text = str(ttc).replace(".", ",")
+                total_amount.text = format_decimal(ttc)
     
     # Retourner le XML
-    encoding = 'ISO-8859-1'
-    if 'encoding="UTF-8"' in invoice_content or "encoding='UTF-8'" in invoice_content:
-        encoding = 'UTF-8'
-    
-    return etree.tostring(tree, encoding=encoding, pretty_print=True, xml_declaration=True).decode(encoding)
+    return etree.tostring(tree, encoding=encoding, pretty_print=True, xml_declaration=True)
 
 # ═══════════════════════════════════════════════════════════════════════════
 # INTERFACE STREAMLIT
 # ═══════════════════════════════════════════════════════════════════════════
 
 def main():
+    # Table des rubriques de la session (taux déjà en Decimal)
+    rubrics = load_rubrics()
+    
     # En-tête
     st.title("📄 Pixid Invoice Updater")
     st.markdown("**Enrichissement de factures SIDES avec données RAV**")
@@ -452,8 +593,6 @@ def main():
         # Gestion des rubriques
         st.subheader("📋 Rubriques")
         
-        rubrics = load_rubrics()
-        
         # Afficher les rubriques actuelles
         with st.expander("Voir les rubriques configurées", expanded=False):
             for code, (libelle, taux, type_ligne) in rubrics.items():
@@ -468,14 +607,14 @@ def main():
         
         if st.button("➕ Ajouter"):
             if new_code and new_libelle:
-                rubrics[new_code] = (new_libelle, float(new_taux), new_type)
+                rubrics[new_code] = (new_libelle, Decimal(str(new_taux)), new_type)
                 st.session_state.rubrics = rubrics
                 st.success(f"Rubrique {new_code} ajoutée!")
                 st.rerun()
         
         # Réinitialiser les rubriques
         if st.button("🔄 Réinitialiser les rubriques"):
-            st.session_state.rubrics = DEFAULT_RUBRICS.copy()
+            st.session_state.rubrics = dict(get_default_rubrics())
             st.success("Rubriques réinitialisées!")
             st.rerun()
     
@@ -527,12 +666,15 @@ def main():
             if st.button("🚀 Lancer le traitement", type="primary", use_container_width=True):
                 try:
                     with st.spinner("Analyse des fichiers en cours..."):
-                        # Décoder les fichiers
-                        rav_content = rav_file.getvalue().decode('utf-8', errors='replace')
-                        invoice_content = invoice_file.getvalue().decode('utf-8', errors='replace')
+                        # Lire les fichiers (octets bruts, sans décodage intermédiaire)
+                        rav_content = rav_file.getvalue()
+                        invoice_content = invoice_file.getvalue()
+                        
+                        # Parser la facture une seule fois (analyse + mise à jour)
+                        invoice_tree, invoice_ns = parse_invoice(invoice_content)
                         
                         # Analyser le RAV
-                        qty_dict, period_start, period_end, timecard_id, details = read_rav_content(rav_content)
+                        qty_dict, period_start, period_end, timecard_id, details, rav_ns = read_rav_content(rav_content)
                         
                         # Afficher l'analyse
                         st.markdown("### 📊 Analyse des fichiers")
@@ -544,21 +686,22 @@ def main():
                             st.info(f"""
                             - **Période**: {period_start} → {period_end}
                             - **TimeCard ID**: {timecard_id}
+                            - **Namespace**: {('2007-04-15' if rav_ns == NS_2007 else '2004-08-02') if rav_ns else 'non détecté'}
                             - **Rubriques trouvées**: {len(qty_dict)}
                             """)
                             
                             # Détails des rubriques
                             if qty_dict:
-                                rubrics = load_rubrics()
+                                rubrics_get = rubrics.get
                                 total_heures = Decimal("0")
                                 total_montant = Decimal("0")
                                 
                                 data = []
                                 for code, heures in qty_dict.items():
                                     heures = heures.quantize(Decimal("0.00"))
-                                    if code in rubrics:
-                                        libelle, taux, type_ligne = rubrics[code]
-                                        taux = Decimal(str(taux))
+                                    rubric = rubrics_get(code)
+                                    if rubric is not None:
+                                        libelle, taux, type_ligne = rubric
                                     else:
                                         libelle = f"Rubrique {code}"
                                         taux = Decimal("0")
@@ -584,23 +727,18 @@ def main():
                         with col2:
                             st.markdown("#### Facture")
                             # Analyser la facture
-                            parser = etree.XMLParser(remove_blank_text=True)
-                            tree = etree.fromstring(invoice_content.encode('utf-8'), parser)
-                            root_tag = tree.tag.split('}')[-1] if '}' in tree.tag else tree.tag
+                            root_tag = invoice_tree.tag.split('}')[-1] if '}' in invoice_tree.tag else invoice_tree.tag
                             
-                            ns = detect_namespace(etree.ElementTree(tree))
-                            invoice = tree.find(".//ns:Invoice", namespaces=ns)
-                            if invoice is None:
-                                invoice = tree.find(".//Invoice")
+                            invoice = find_invoice(invoice_tree, invoice_ns)
                             
                             info_text = f"- **Structure**: {root_tag}\n"
-                            info_text += f"- **Namespace**: {'2007-04-15' if ns == NS_2007 else '2004-08-02'}\n"
+                            info_text += f"- **Namespace**: {'2007-04-15' if invoice_ns == NS_2007 else '2004-08-02'}\n"
                             
                             if invoice is not None:
                                 # Compter les lignes existantes
-                                main_line = invoice.find(".//{%s}Line[{%s}LineNumber='1']" % (ns["oa"], ns["oa"]))
+                                main_line = find_main_line(invoice)
                                 if main_line is not None:
-                                    sublines = main_line.findall("{%s}Line" % ns["oa"])
+                                    sublines = main_line.findall(OA_LINE_TAG)
                                     info_text += f"- **Lignes existantes**: {len(sublines)}\n"
                             
                             st.info(info_text)
@@ -614,7 +752,10 @@ def main():
                             'timecard_id': timecard_id
                         }
                         
-                        updated_content = update_invoice(invoice_content, rav_data)
+                        output_encoding = document_encoding(invoice_tree)
+                        updated_bytes = update_invoice(
+                            invoice_tree, invoice_ns, rav_data, rubrics, output_encoding
+                        )
                         
                         # Succès
                         st.markdown("---")
@@ -622,22 +763,14 @@ def main():
                         
                         # Aperçu
                         with st.expander("📋 Aperçu du fichier généré", expanded=False):
-                            lines = updated_content.split('\n')[:50]
-                            preview = '\n'.join(lines)
-                            if len(updated_content.split('\n')) > 50:
-                                preview += "\n... (fichier tronqué pour l'affichage)"
-                            st.code(preview, language='xml')
+                            st.code(build_preview(updated_bytes, output_encoding), language='xml')
                         
                         # Téléchargement
                         output_filename = invoice_file.name.replace('.xml', '_enriched.xml')
                         
-                        encoding = 'ISO-8859-1'
-                        if 'encoding="UTF-8"' in updated_content:
-                            encoding = 'UTF-8'
-                        
                         st.download_button(
                             label="💾 Télécharger le fichier enrichi",
-                            data=updated_content.encode(encoding),
+                            data=updated_bytes,
                             file_name=output_filename,
                             mime="text/xml",
                             type="primary",